@@ -1,28 +1,216 @@
+from __future__ import annotations
+
 import os
+import re
+import time
 import logging
-import requests
 import asyncio
-from telegram import Update, InputFile
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+import aiohttp
+import orjson
+import redis.asyncio as redis
+from aiolimiter import AsyncLimiter
 from io import BytesIO
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
 NEWS_API_KEY = os.getenv("NEWS_API_KEY")
 STABILITY_API_KEY = os.getenv("STABILITY_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+
+REQUEST_TIMEOUT = 30
+STREAM_EDIT_INTERVAL = 1.0
+TELEGRAM_TEXT_LIMIT = 4000
+NEWS_CACHE_TTL = 300
+PRICE_CACHE_TTL = 60
+CHAT_HISTORY_MESSAGES = 12
+CHAT_HISTORY_TTL = 3600
+BRIEF_DEFAULT_COINS = ("bitcoin", "ethereum")
+BRIEF_MAX_COINS = 5
+
+COINGECKO_API_URL = "https://api.coingecko.com/api/v3"
+# CoinGecko's free tier allows roughly 30 calls a minute; stay just under it.
+COINGECKO_LIMITER = AsyncLimiter(25, 60)
+
+WELCOME_MESSAGE = (
+    "👋 Welcome to CreativeSync AI Bot!\n"
+    "Use /ask <your question> to chat with Llama-3.\n"
+    "Use /news for trending news\n"
+    "Use /brief [coins] for prices and headlines at a glance\n"
+    "Use /image <prompt> to generate an image\n"
+    "Use /help to see this again."
+)
+
+# One alternation for every plain-text intent; the matching group's name picks
+# the handler from INTENT_HANDLERS, so adding an intent never adds a branch.
+# Whole-message intents are anchored lookaheads listed first: they can only
+# match at position 0, where they are tried before any keyword, so a question
+# that mentions "start" is still answered as a question.
+INTENT_RE = re.compile(
+    r"(?P<ask>^(?=.*\?\s*$))|(?P<greet>\b(?:hi|hello|hey|start)\b)",
+    re.IGNORECASE | re.DOTALL,
+)
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_message = (
-        "👋 Welcome to CreativeSync AI Bot!\n"
-        "Use /ask <your question> to chat with Llama-3.\n"
-        "Use /news for trending news\n"
-        "Use /image <prompt> to generate an image\n"
-        "Use /help to see this again."
+async def post_init(app: Application):
+    # One pooled session for every outbound API call, kept apart from the
+    # HTTP pool python-telegram-bot uses for polling and sending messages.
+    app.bot_data["session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75)
     )
-    await update.message.reply_text(welcome_message)
+    app.bot_data["coin_index"] = {}
+    # Independent startup round-trips run side by side, so polling starts
+    # after the slowest of them rather than after their sum.
+    await asyncio.gather(connect_redis(app), load_coin_index(app))
+
+async def connect_redis(app: Application):
+    # Caching is optional: without REDIS_URL every request goes upstream.
+    if not REDIS_URL:
+        app.bot_data["redis"] = None
+        return
+    app.bot_data["redis"] = redis.from_url(REDIS_URL, decode_responses=True)
+    try:
+        await app.bot_data["redis"].ping()
+    except redis.RedisError as e:
+        # The client reconnects on demand; until then cache calls just miss.
+        logger.warning("Redis is unreachable at startup: %s", e)
+
+async def post_shutdown(app: Application):
+    await app.bot_data["session"].close()
+    if app.bot_data["redis"] is not None:
+        await app.bot_data["redis"].aclose()
+
+async def cache_get(context: ContextTypes.DEFAULT_TYPE, key):
+    r = context.bot_data["redis"]
+    if r is None:
+        return None
+    try:
+        return await r.get(key)
+    except redis.RedisError:
+        logger.warning("Redis GET failed for %s", key, exc_info=True)
+        return None
+
+async def cache_get_many(context: ContextTypes.DEFAULT_TYPE, keys):
+    r = context.bot_data["redis"]
+    if r is None:
+        return [None] * len(keys)
+    try:
+        return await r.mget(keys)
+    except redis.RedisError:
+        logger.warning("Redis MGET failed for %s", keys, exc_info=True)
+        return [None] * len(keys)
+
+async def cache_set_many(context: ContextTypes.DEFAULT_TYPE, entries):
+    # entries: (key, value, ttl) tuples, written in a single round trip.
+    r = context.bot_data["redis"]
+    if r is None or not entries:
+        return
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            for key, value, ttl in entries:
+                pipe.set(key, value, ex=ttl)
+            await pipe.execute()
+    except redis.RedisError:
+        logger.warning("Redis pipelined SET failed for %s", [key for key, _, _ in entries], exc_info=True)
+
+async def history_get(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    r = context.bot_data["redis"]
+    if r is None:
+        return []
+    try:
+        return [orjson.loads(m) for m in await r.lrange(f"chat:{chat_id}", 0, -1)]
+    except redis.RedisError:
+        logger.warning("Redis LRANGE failed for chat %s", chat_id, exc_info=True)
+        return []
+
+async def history_append(context: ContextTypes.DEFAULT_TYPE, chat_id, *messages):
+    r = context.bot_data["redis"]
+    if r is None:
+        return
+    key = f"chat:{chat_id}"
+    try:
+        async with r.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *(orjson.dumps(m) for m in messages))
+            pipe.ltrim(key, -CHAT_HISTORY_MESSAGES, -1)
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            await pipe.execute()
+    except redis.RedisError:
+        logger.warning("Redis history update failed for chat %s", chat_id, exc_info=True)
+
+async def _request_json(session, method, url, **kwargs):
+    async with session.request(method, url, **kwargs) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
+async def _request_bytes(session, method, url, **kwargs):
+    async with session.request(method, url, **kwargs) as response:
+        response.raise_for_status()
+        return await response.read()
+
+async def fetch_json(session, method, url, **kwargs):
+    return await asyncio.wait_for(_request_json(session, method, url, **kwargs), timeout=REQUEST_TIMEOUT)
+
+async def fetch_bytes(session, method, url, **kwargs):
+    return await asyncio.wait_for(_request_bytes(session, method, url, **kwargs), timeout=REQUEST_TIMEOUT)
+
+async def stream_chat(session, headers, data):
+    # Together.ai streams OpenAI-style server-sent events, one "data: {...}"
+    # line per token batch, terminated by "data: [DONE]". There is no total
+    # deadline so long answers aren't cut off mid-stream, but getting a pooled
+    # connection, connecting, and each read are all bounded.
+    timeout = aiohttp.ClientTimeout(connect=REQUEST_TIMEOUT, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    payload = {**data, "stream": True}
+    async with session.post(
+        "https://api.together.xyz/v1/chat/completions", headers=headers, json=payload, timeout=timeout
+    ) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            chunk = line[5:].strip()
+            if chunk == b"[DONE]":
+                break
+            delta = orjson.loads(chunk)["choices"][0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+async def _request_coingecko(session, path, params):
+    async with COINGECKO_LIMITER:
+        return await _request_json(session, "GET", f"{COINGECKO_API_URL}{path}", params=params)
+
+async def fetch_coingecko(session, path, params):
+    # The timeout covers waiting for a limiter slot too, so a saturated
+    # limiter fails the call instead of queueing it for minutes.
+    return await asyncio.wait_for(_request_coingecko(session, path, params), timeout=REQUEST_TIMEOUT)
+
+_inflight = {}
+
+async def single_flight(key, factory):
+    # Concurrent callers asking for the same key share one upstream request.
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+
+        def _done(t):
+            _inflight.pop(key, None)
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_done)
+    # Shield so one caller timing out or being cancelled doesn't cancel the
+    # fetch for everyone else waiting on it.
+    return await asyncio.shield(task)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(WELCOME_MESSAGE)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start(update, context)
@@ -35,46 +223,245 @@ async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not prompt:
         await update.message.reply_text("❗ Usage: /ask <your message>")
         return
+    await answer(update, context, prompt)
 
-    await update.message.chat.send_action(action="typing")
+async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt):
     headers = {
         "Authorization": f"Bearer {TOGETHER_API_KEY}",
         "Content-Type": "application/json"
     }
+    chat_id = update.effective_chat.id
+    question = {"role": "user", "content": prompt}
+    history = await history_get(context, chat_id)
     data = {
         "model": "meta-llama/Llama-3-70b-instruct",
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": history + [question],
         "max_tokens": 200
     }
+    # Post a placeholder right away and grow it as tokens arrive, instead of
+    # making the user wait for the whole completion.
+    message = await update.message.reply_text("…")
+    reply = ""
+    shown = ""
+    last_edit = time.monotonic()
     try:
-        response = requests.post("https://api.together.xyz/v1/chat/completions", headers=headers, json=data)
-        result = response.json()
-        reply = result["choices"][0]["message"]["content"]
-        await update.message.reply_text(reply)
+        async for delta in stream_chat(context.bot_data["session"], headers, data):
+            reply += delta
+            if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                # Telegram strips surrounding whitespace, so compare what it
+                # would actually show or the edit fails as "not modified".
+                text = reply[-TELEGRAM_TEXT_LIMIT:].strip()
+                if text and text != shown and await edit_stream_message(context, message, text):
+                    shown = text
+                last_edit = time.monotonic()
+        if not reply.strip():
+            raise ValueError("empty completion")
     except Exception as e:
-        await update.message.reply_text("💥 Error contacting Llama-3 API.")
+        logger.warning("Together.ai request failed: %s", e)
+        await edit_stream_message(context, message, "💥 Error contacting Llama-3 API.", final=True)
+        return
+
+    text = reply[-TELEGRAM_TEXT_LIMIT:].strip()
+    if text != shown:
+        await edit_stream_message(context, message, text, final=True)
+    await history_append(context, chat_id, question, {"role": "assistant", "content": reply})
+
+async def edit_stream_message(context: ContextTypes.DEFAULT_TYPE, message, text, final=False):
+    # Intermediate edits are best effort: a rejected or throttled edit must
+    # not abort the stream, whether Telegram rejects it, throttles it or the
+    # request times out. A throttled final edit is retried from a background
+    # task once flood control lifts, so the handler never sleeps.
+    from telegram.error import RetryAfter, TelegramError
+
+    try:
+        await message.edit_text(text)
+        return True
+    except RetryAfter as e:
+        if final:
+            context.application.create_task(_edit_later(message, text, e.retry_after))
+        return False
+    except TelegramError as e:
+        logger.debug("Skipping edit of streamed reply: %s", e)
+        return False
+
+async def _edit_later(message, text, delay):
+    from telegram.error import TelegramError
+
+    await asyncio.sleep(delay)
+    try:
+        await message.edit_text(text)
+    except TelegramError as e:
+        logger.warning("Final edit of streamed reply failed: %s", e)
+
+async def greet_intent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(WELCOME_MESSAGE)
+
+async def ask_intent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if TOGETHER_API_KEY:
+        await answer(update, context, update.message.text)
+
+INTENT_HANDLERS = {
+    "greet": greet_intent,
+    "ask": ask_intent,
+}
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    match = INTENT_RE.search(update.message.text)
+    if match:
+        await INTENT_HANDLERS[match.lastgroup](update, context)
+
+async def fetch_latest_news(context: ContextTypes.DEFAULT_TYPE):
+    # Callers check news:headlines themselves, so a hit can reply before any
+    # typing action is sent.
+    return await single_flight("news:headlines", lambda: _fetch_latest_news(context))
+
+async def _fetch_latest_news(context: ContextTypes.DEFAULT_TYPE):
+    # The key goes in a header: aiohttp errors include the request URL, and
+    # those are logged when NewsAPI rejects or rate-limits a call.
+    res = await fetch_json(
+        context.bot_data["session"], "GET", "https://newsapi.org/v2/top-headlines",
+        params={"country": "us"}, headers={"X-Api-Key": NEWS_API_KEY},
+    )
+    articles = res.get("articles", [])[:5]
+    reply = "📰 Top News:\n\n"
+    reply += "\n".join(
+        [f"{a.get('title', 'No Title')} - {a.get('url', 'No URL')}" for a in articles]
+    )
+    await cache_set_many(context, [
+        ("news:headlines", reply, NEWS_CACHE_TTL),
+        ("stale:news:headlines", reply, None),
+    ])
+    return reply
+
+async def fetch_crypto_prices(context: ContextTypes.DEFAULT_TYPE, coins):
+    # Returns {coin: rendered line} for coins missing from the cache; coins
+    # CoinGecko can't quote are left out. All of them share one /simple/price
+    # call, so a 5-coin /brief spends one request of the CoinGecko budget.
+    coins = sorted(coins)
+    return await single_flight(("price", tuple(coins)), lambda: _fetch_crypto_prices(context, coins))
+
+async def _fetch_crypto_prices(context: ContextTypes.DEFAULT_TYPE, coins):
+    params = {"ids": ",".join(coins), "vs_currencies": "usd", "include_market_cap": "true", "include_24hr_change": "true"}
+    res = await fetch_coingecko(context.bot_data["session"], "/simple/price", params)
+    prices = {}
+    for coin in coins:
+        # Unknown ids are missing, and ids CoinGecko has no USD quote for come
+        # back as {} or with "usd": null; skip them so only their line blanks.
+        if res.get(coin, {}).get("usd") is None:
+            continue
+        # Cache the rendered line, not the raw JSON, so hits skip formatting.
+        prices[coin] = format_price(coin, res[coin])
+    await cache_set_many(context, [
+        entry
+        for coin, line in prices.items()
+        for entry in ((f"price:{coin}", line, PRICE_CACHE_TTL), (f"stale:price:{coin}", line, None))
+    ])
+    return prices
+
+async def load_coin_index(app: Application):
+    # Map CoinGecko ids, symbols and names of the top coins by market cap to
+    # their id, so "btc" or "Ethereum" resolve without an upstream miss. Pages
+    # are walked biggest first, so the largest coin wins a shared symbol.
+    index = {}
+    try:
+        for page in (1, 2):
+            params = {"vs_currency": "usd", "order": "market_cap_desc", "per_page": 250, "page": page}
+            for coin in await fetch_coingecko(app.bot_data["session"], "/coins/markets", params):
+                index.setdefault(coin["id"], coin["id"])
+                index.setdefault(coin["symbol"].lower(), coin["id"])
+                index.setdefault(coin["name"].lower(), coin["id"])
+    except Exception as e:
+        logger.warning("Loading CoinGecko coin index failed: %s", e)
+    app.bot_data["coin_index"] = index
+    logger.info("Loaded %d CoinGecko coin aliases", len(index))
+
+def resolve_coin(context: ContextTypes.DEFAULT_TYPE, name):
+    name = name.lower()
+    return context.bot_data["coin_index"].get(name, name)
+
+def format_price(coin, data):
+    change = data.get("usd_24h_change") or 0
+    return (
+        f"🪙 {coin.title()}: ${data['usd']:,.2f} ({change:+.2f}% 24h)\n"
+        f"    Market cap: ${data.get('usd_market_cap') or 0:,.0f}"
+    )
 
 async def news(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not NEWS_API_KEY:
         await update.message.reply_text("❌ NEWS_API_KEY not set.")
         return
 
+    reply = await cache_get(context, "news:headlines")
+    if reply is not None:
+        await update.message.reply_text(reply, disable_web_page_preview=True)
+        return
+
     await update.message.chat.send_action(action="typing")
     try:
-        url = f"https://newsapi.org/v2/top-headlines?country=us&apiKey={NEWS_API_KEY}"
-        res = requests.get(url).json()
-        articles = res.get("articles", [])[:5]
-        reply = "📰 Top News:\n\n"
-        reply += "\n".join(
-            [f"{a.get('title', 'No Title')} - {a.get('url', 'No URL')}" for a in articles]
+        reply = await fetch_latest_news(context)
+        await update.message.reply_text(reply, disable_web_page_preview=True)
+    except Exception as e:
+        logger.warning("NewsAPI request failed: %s", e)
+        stale = await cache_get(context, "stale:news:headlines")
+        if stale is not None:
+            await update.message.reply_text(f"{stale}\n\n(cached)", disable_web_page_preview=True)
+        else:
+            await update.message.reply_text("💥 Error fetching news.")
+
+async def brief(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    coins = list(dict.fromkeys(resolve_coin(context, c) for c in context.args))[:BRIEF_MAX_COINS]
+    coins = coins or list(BRIEF_DEFAULT_COINS)
+
+    # Everything that is cached comes back in one MGET; only misses go
+    # upstream, and only then is it worth showing a typing action.
+    cached = await cache_get_many(context, [f"price:{coin}" for coin in coins] + ["news:headlines"])
+    prices = {coin: line for coin, line in zip(coins, cached) if line is not None}
+    headlines = cached[-1] if NEWS_API_KEY else None
+    misses = [coin for coin in coins if coin not in prices]
+    fetch_news = NEWS_API_KEY and headlines is None
+
+    if misses or fetch_news:
+        await update.message.chat.send_action(action="typing")
+        # Fan out to CoinGecko and NewsAPI at once; one failed source should
+        # not cost the user the rest of the brief.
+        fetched, fetched_news = await asyncio.gather(
+            fetch_crypto_prices(context, misses) if misses else asyncio.sleep(0, {}),
+            fetch_latest_news(context) if fetch_news else asyncio.sleep(0, headlines),
+            return_exceptions=True,
         )
-        await update.message.reply_text(reply)
+        if isinstance(fetched, Exception):
+            logger.warning("Price lookup for %s failed: %s", misses, fetched)
+        else:
+            prices.update(fetched)
+        if isinstance(fetched_news, Exception):
+            logger.warning("NewsAPI request failed: %s", fetched_news)
+            headlines = None
+        else:
+            headlines = fetched_news
 
-    except Exception as e:
-        await update.message.reply_text("💥 Error fetching news.")
-        await update.message.reply_text(reply)
-    except Exception:
-        await update.message.reply_text("💥 Error fetching news.")
+    # Whatever is still missing falls back to its stale copy, again in one MGET.
+    unpriced = [coin for coin in coins if coin not in prices]
+    stale_keys = [f"stale:price:{coin}" for coin in unpriced]
+    if NEWS_API_KEY and headlines is None:
+        stale_keys.append("stale:news:headlines")
+    stale = dict(zip(stale_keys, await cache_get_many(context, stale_keys))) if stale_keys else {}
+    if NEWS_API_KEY and headlines is None:
+        stale_news = stale.get("stale:news:headlines")
+        headlines = f"{stale_news}\n\n(cached)" if stale_news is not None else "⚠️ News unavailable right now."
+
+    lines = []
+    for coin in coins:
+        stale_line = stale.get(f"stale:price:{coin}")
+        if coin in prices:
+            lines.append(prices[coin])
+        elif stale_line is not None:
+            lines.append(f"{stale_line} (cached)")
+        else:
+            lines.append(f"⚠️ {coin}: price unavailable")
+    if NEWS_API_KEY:
+        lines.append("")
+        lines.append(headlines)
+    await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
 
 async def image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not STABILITY_API_KEY:
@@ -93,8 +480,7 @@ async def image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Content-Type": "application/json"
         }
         json_data = {"text_prompts": [{"text": prompt}], "cfg_scale": 7, "height": 512, "width": 512, "samples": 1}
-        res = requests.post(stability_url, headers=headers, json=json_data)
-        image_data = res.content
+        image_data = await fetch_bytes(context.bot_data["session"], "POST", stability_url, headers=headers, json=json_data)
         await update.message.reply_photo(photo=BytesIO(image_data))
     except Exception:
         await update.message.reply_text("💥 Error generating image.")
@@ -104,12 +490,44 @@ def main():
         print("❌ BOT_TOKEN not set.")
         return
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Set the loop policy before the builder creates any asyncio primitives,
+    # so they bind to the same loop run_polling() ends up using.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Imported here so a misconfigured start exits without paying for
+    # python-telegram-bot's import time.
+    from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, MessageHandler, filters
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # Outbound sends and getUpdates long-polling get separate pools so a
+        # burst of replies never starves polling (and vice versa).
+        .connection_pool_size(32)
+        .pool_timeout(30)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(60)
+        .rate_limiter(AIORateLimiter())
+        # Handle updates concurrently (PTB defaults to one at a time), so a
+        # slow upstream in one chat doesn't hold up every other chat and
+        # identical in-flight fetches can actually be coalesced.
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("ask", ask))
     app.add_handler(CommandHandler("news", news))
+    app.add_handler(CommandHandler("brief", brief))
     app.add_handler(CommandHandler("image", image))
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, handle_message))
     app.run_polling()
 
 if __name__ == "__main__":